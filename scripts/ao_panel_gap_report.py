@@ -0,0 +1,608 @@
+#!/usr/bin/env python3
+"""Gap report: AO panel review findings vs ao-lens audit results.
+
+The dev-team saga pipeline runs a multi-expert "AO panel" review over each
+AO process and records the outcome as ``ao_panel_completed`` events on the
+``dev_team:saga_events:<saga_id>`` Redis streams.  This script collects
+panel issues (from Redis, or from saved Claude panel transcripts), runs
+ao-lens over the same Lua sources (or reads saved ``ao-lens-*.json``
+reports), and reports which panel findings ao-lens does and does not
+catch -- the gaps that need new checks or skill rules.
+
+Usage:
+  ao_panel_gap_report.py --recent 20 --source examples/
+  ao_panel_gap_report.py --from-redis <saga_id> --source examples/
+  ao_panel_gap_report.py --claude-output run.txt --lens-output out/ --report gap-report.md
+"""
+
+import argparse
+import atexit
+import json
+import mmap
+import os
+import re
+import string
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
+
+try:
+    import redis
+except ImportError:  # Redis-backed modes only; transcript modes work without it.
+    redis = None
+
+try:
+    import orjson
+    _loads = orjson.loads  # 1.5-2x faster decode; accepts str or bytes.
+except ImportError:
+    _loads = json.loads
+
+try:
+    import ahocorasick  # pyahocorasick: one-pass multi-phrase matching.
+except ImportError:
+    ahocorasick = None
+
+REDIS_HOST = os.environ.get("REDIS_HOST", "localhost")
+REDIS_PORT = int(os.environ.get("REDIS_PORT", "6379"))
+
+SAGA_EVENTS_PATTERN = "dev_team:saga_events:*"
+
+# Keys Redis inspects per SCAN iteration.  The default (10) means thousands
+# of round-trips on a large keyspace; 1024 amortizes the network latency.
+# Module-level so deployments can tune it.
+SCAN_COUNT = 1024
+
+# Streams fetched per pipelined XRANGE batch.
+PIPELINE_CHUNK = 500
+
+# Entries read per stream in --recent mode (newest first); only a handful
+# of recent panel events are needed, so never walk a whole stream.
+XREVRANGE_COUNT = 200
+
+# Window size when walking a single saga's stream forward in --from-redis.
+XRANGE_WINDOW = 500
+
+CLI_JS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "dist", "cli.js")
+MCP_SERVER_JS = os.path.join(os.path.dirname(CLI_JS), "mcp-server.js")
+
+# Panel experts, mirroring the skill files under skills/ao/.
+EXPERTS = [
+    "security",
+    "authorization",
+    "determinism",
+    "frozen-state",
+    "handler-patterns",
+    "json-safety",
+    "nil-safety",
+    "replay-safe-init",
+]
+
+# Phrases that panel experts use in issue descriptions, mapped to the
+# ao-lens check or skill-rule code(s) that should fire for the same
+# problem.  A tuple means any one of those codes counts as coverage.
+ISSUE_TO_RULE_MAPPING = {
+    # Nil access is guarded by several site-specific checks/rules.
+    "nil guard": ("MSG_TAGS_NO_NIL_GUARD", "AO_SEND_TARGET_NO_NIL_GUARD",
+                  "TABLE_ACCESS_NO_NIL_CHECK", "NIL_CONCAT_CRASH",
+                  "NIL_EQUALS_NIL_BYPASS"),
+    "nil == nil": "NIL_EQUALS_NIL_BYPASS",
+    "owner never set": "OWNER_NEVER_INITIALIZED",
+    "owner never initialized": "OWNER_NEVER_INITIALIZED",
+    "shadows global state": "LOCAL_STATE_SHADOW",
+    "first caller wins": "FIRST_CALLER_WINS_OWNER",
+    "wipes state on replay": "STATE_OVERWRITE_ON_REPLAY",
+    "no auth check": "NO_AUTH_CHECK",
+    "missing authorization": "NO_AUTH_CHECK",
+    "no frozen check": "NO_FROZEN_CHECK",
+    "emergency stop": "NO_FROZEN_CHECK",
+    "json.decode without pcall": "JSON_DECODE_NO_PCALL",
+    "json.encode without pcall": "JSON_ENCODE_NO_PCALL",
+    "os.time": "OS_TIME_USAGE",
+    "math.random": "MATH_RANDOM_UNSEEDED",
+    "always-true matcher": "ALWAYS_TRUE_MATCHER",
+    "no action check": "MATCHER_NO_ACTION_CHECK",
+    "no response": "MUTATING_HANDLER_NO_RESPONSE",
+    "no bounds": "NO_BOUNDS_DEFINED",
+    "no schema validation": "NO_SCHEMA_VALIDATION",
+}
+
+# Lowercased view of the mapping, built once at import; matching code
+# must never pay per-call .lower() on keys that do not change.
+_ISSUE_TO_RULE_LOWER = {
+    phrase.lower(): rule for phrase, rule in ISSUE_TO_RULE_MAPPING.items()
+}
+
+# Panel descriptions sometimes carry an explicit severity prefix
+# ("critical: ...", "P1 ...").  Used to bucket the gap report.
+SEVERITY_PREFIXES = {
+    "critical": ["critical:", "crit:", "sev0", "p0"],
+    "high": ["high:", "sev1", "p1"],
+    "medium": ["medium:", "med:", "sev2", "p2"],
+    "low": ["low:", "sev3", "p3"],
+}
+
+# Single verdict-line pattern covering every expert, compiled once at
+# import.  One finditer pass tokenizes expert, verdict, description and
+# missing together; a re.Scanner would buy nothing on top of this and is
+# str-only, which would break the mmap path below.
+_VERDICT_RE = re.compile(
+    rf"^\[(?P<expert>{'|'.join(map(re.escape, EXPERTS))})\]"
+    rf"\s+verdict:\s*(?P<verdict>PASS|FAIL|WARN)"
+    rf"\s+description:\s*(?P<description>.*?)"
+    rf"(?:\s+missing:\s*(?P<missing>\S+))?\s*$",
+    re.MULTILINE | re.IGNORECASE,
+)
+
+# Bytes twin of _VERDICT_RE so mmap'd transcripts can be scanned in place.
+_VERDICT_RE_B = re.compile(
+    _VERDICT_RE.pattern.encode("ascii"), re.MULTILINE | re.IGNORECASE
+)
+
+# Pre-filter hints; case-insensitive to match _VERDICT_RE, and far cheaper
+# than the full pattern on transcripts with no verdict lines.
+_VERDICT_HINT_RE = re.compile(r"verdict:", re.IGNORECASE)
+_VERDICT_HINT_RE_B = re.compile(rb"verdict:", re.IGNORECASE)
+
+_ASCII_LOWER = str.maketrans(string.ascii_uppercase, string.ascii_lowercase)
+
+
+@lru_cache(maxsize=4096)
+def _lower(text):
+    """ASCII-lowercase via a translate table, memoized.
+
+    Every description is lowered by map_issue_to_rule and again by
+    bucket_by_severity; the cache makes the second (and any repeat) free.
+    """
+    return text.translate(_ASCII_LOWER)
+
+
+def redis_client():
+    if redis is None:
+        raise RuntimeError("redis-py is required for --recent / --from-redis modes")
+    # Binary mode: details blobs go straight to orjson as bytes, skipping
+    # a per-field UTF-8 decode; callers decode the few fields they print.
+    return redis.Redis(host=REDIS_HOST, port=REDIS_PORT)
+
+
+def get_ao_panel_from_redis(saga_id):
+    """Collect panel issues recorded for a single saga."""
+    r = redis_client()
+    issues = []
+    # The key shape is fixed, so read the saga's stream directly; a SCAN
+    # with a trailing wildcard also swept up any saga sharing the prefix
+    # (saga1 pulled in saga10, saga12, ...).
+    key = f"dev_team:saga_events:{saga_id}"
+    last_id = "-"
+    while True:
+        entries = r.xrange(key, min=last_id, count=XRANGE_WINDOW)
+        if not entries:
+            break
+        for _entry_id, data in entries:
+            if data.get(b"event_type", b"") != b"ao_panel_completed":
+                continue
+            details = _loads(data.get(b"details", b"{}"))
+            issues.extend(details.get("issues", []))
+        # "(" makes the next window start after the last entry seen.
+        last_id = b"(" + entries[-1][0]
+    return issues
+
+
+def get_recent_ao_panel_issues(limit):
+    """Collect up to *limit* unique panel issues across recent sagas."""
+    r = redis_client()
+    all_issues = []
+    seen = set()
+    keys = list(r.scan_iter(match=SAGA_EVENTS_PATTERN, count=SCAN_COUNT))
+    for start in range(0, len(keys), PIPELINE_CHUNK):
+        chunk = keys[start:start + PIPELINE_CHUNK]
+        pipe = r.pipeline(transaction=False)
+        for key in chunk:
+            # Newest entries first, capped: panel events sit near the tail
+            # of each stream and only O(limit) of them are wanted.
+            pipe.xrevrange(key, count=XREVRANGE_COUNT)
+        results = pipe.execute()
+        for key, events in zip(chunk, results):
+            saga_id = key.split(b":")[-1].decode()
+            for _entry_id, data in events:
+                if data.get(b"event_type", b"") != b"ao_panel_completed":
+                    continue
+                details = _loads(data.get(b"details", b"{}"))
+                for issue in details.get("issues", []):
+                    # Dedupe at collection time so repeated panel runs of
+                    # the same saga don't burn the limit on copies.
+                    desc = _normalize_desc(issue.get("description", ""))
+                    if desc in seen:
+                        continue
+                    seen.add(desc)
+                    issue = dict(issue)
+                    issue["saga_id"] = saga_id
+                    all_issues.append(issue)
+                    if len(all_issues) >= limit:
+                        return all_issues
+    return all_issues
+
+
+def parse_ao_panel_verdicts(text):
+    """Extract structured issues from an AO panel transcript.
+
+    Transcript lines look like:
+      [security] verdict: FAIL description: critical: owner check passes when nil missing: NIL_GUARD_REQUIRED
+    """
+    # Accepts str or a bytes-like buffer (e.g. an mmap'd transcript, which
+    # is scanned in place without copying the file into a str).
+    binary = not isinstance(text, str)
+    # Cheap scan for the verdict marker before paying for the full pattern;
+    # most transcript chunks contain no verdict lines at all.  Must stay
+    # case-insensitive since _VERDICT_RE is compiled with IGNORECASE.
+    hint = _VERDICT_HINT_RE_B if binary else _VERDICT_HINT_RE
+    if hint.search(text) is None:
+        return []
+    issues = []
+    pattern = _VERDICT_RE_B if binary else _VERDICT_RE
+    for match in pattern.finditer(text):
+        expert, verdict, description, missing = match.group(
+            "expert", "verdict", "description", "missing"
+        )
+        if binary:
+            expert = expert.decode("utf-8")
+            verdict = verdict.decode("ascii")
+            description = description.decode("utf-8", "replace")
+            missing = missing.decode("ascii") if missing else missing
+        verdict = verdict.upper()
+        if verdict == "PASS":
+            continue
+        issues.append({
+            "expert": expert.lower(),
+            "verdict": verdict,
+            "description": description.strip(),
+            "missing": missing,
+        })
+    return issues
+
+
+def parse_claude_output(path):
+    """Parse a saved Claude panel transcript into issues."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return []
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            return parse_ao_panel_verdicts(mm)
+
+
+def _flatten_findings(report):
+    """Audit reports nest findings per file; return them as one list."""
+    findings = []
+    for file_report in report.get("files", []):
+        findings.extend(file_report.get("findings", []))
+    return findings
+
+
+class AoLensWorker:
+    """Long-running ao-lens worker speaking MCP JSON-RPC over stdio.
+
+    Spawning node per audit pays interpreter plus tree-sitter startup
+    every time; the MCP server (shipped as ao-lens-mcp) loads once and
+    serves security_audit calls for the life of the process.
+    """
+
+    def __init__(self):
+        self._proc = subprocess.Popen(
+            ["node", MCP_SERVER_JS],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        self._next_id = 0
+        self._request("initialize", {
+            "protocolVersion": "2024-11-05",
+            "capabilities": {},
+            "clientInfo": {"name": "ao_panel_gap_report", "version": "1.0"},
+        })
+        self._notify("notifications/initialized", {})
+
+    def _send(self, message):
+        self._proc.stdin.write(json.dumps(message).encode() + b"\n")
+        self._proc.stdin.flush()
+
+    def _notify(self, method, params):
+        self._send({"jsonrpc": "2.0", "method": method, "params": params})
+
+    def _request(self, method, params):
+        self._next_id += 1
+        self._send({"jsonrpc": "2.0", "id": self._next_id,
+                    "method": method, "params": params})
+        while True:
+            line = self._proc.stdout.readline()
+            if not line:
+                # Startup failures (missing dist/mcp-server.js, node not on
+                # PATH, ...) only show up on the server's stderr.
+                stderr = self._proc.stderr.read().decode("utf-8", "replace").strip()
+                detail = f": {stderr}" if stderr else ""
+                raise RuntimeError(f"ao-lens worker exited unexpectedly{detail}")
+            message = _loads(line)
+            if message.get("id") != self._next_id:
+                continue  # notifications/log lines from the server
+            if "error" in message:
+                raise RuntimeError(f"ao-lens worker: {message['error']}")
+            return message["result"]
+
+    def audit(self, source):
+        result = self._request("tools/call", {
+            "name": "security_audit",
+            "arguments": {"path": source},
+        })
+        text = result["content"][0]["text"]
+        if result.get("isError"):
+            raise RuntimeError(f"ao-lens audit failed: {text}")
+        return _flatten_findings(_loads(text))
+
+    def close(self):
+        if self._proc.poll() is None:
+            self._proc.stdin.close()
+            try:
+                self._proc.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self._proc.kill()
+
+
+_worker = None
+
+
+def _get_worker():
+    global _worker
+    if _worker is None:
+        _worker = AoLensWorker()
+        atexit.register(_worker.close)
+    return _worker
+
+
+def run_ao_lens(source, skills_dir=None):
+    """Audit *source* with ao-lens and return the flattened findings."""
+    if skills_dir:
+        # Custom skill dirs are a CLI flag the MCP server does not take;
+        # fall back to a one-shot invocation for that case.
+        cmd = ["node", CLI_JS, "audit", source, "--json",
+               "--skills-dir", skills_dir]
+        proc = subprocess.run(cmd, capture_output=True, text=True, check=False)
+        # Without --ci the CLI exits nonzero only for real failures (bad
+        # path, no input files), which report on stderr and leave stdout
+        # empty -- never hand that to the JSON decoder.
+        if proc.returncode != 0 or not proc.stdout.strip():
+            raise RuntimeError(f"ao-lens audit failed: {proc.stderr.strip()}")
+        return _flatten_findings(_loads(proc.stdout))
+    return _get_worker().audit(source)
+
+
+def _load_report_findings(path):
+    with open(path, "rb") as f:
+        report = _loads(f.read())
+    # audit --json nests findings per file; older captures kept a flat
+    # top-level list.  Accept both.
+    if "files" in report:
+        return _flatten_findings(report)
+    return report.get("findings", [])
+
+
+def parse_ao_lens_findings(output_dir):
+    """Collect findings from saved ``ao-lens-*.json`` audit reports."""
+    # os.scandir streams dirents without per-entry Path objects or fnmatch;
+    # the ao-lens-*.json pattern is just a prefix/suffix test.
+    paths = []
+    with os.scandir(output_dir) as entries:
+        for entry in entries:
+            name = entry.name
+            if not (name.startswith("ao-lens-") and name.endswith(".json")):
+                continue
+            if not entry.is_file():
+                continue
+            paths.append(entry.path)
+    findings = []
+    if not paths:
+        return findings
+    # Fan the open+parse out over a bounded pool: the reads are I/O-bound
+    # and independent, and map() keeps directory order in the result.
+    with ThreadPoolExecutor(max_workers=min(8, len(paths))) as pool:
+        for report_findings in pool.map(_load_report_findings, paths):
+            findings.extend(report_findings)
+    return findings
+
+
+def _normalize_desc(description):
+    """Normalize so experts phrasing the same finding with different
+    casing/spacing still collide on one set entry."""
+    return " ".join(description.casefold().split())
+
+
+def deduplicate_issues(issues):
+    """Drop issues repeating an already-kept description (first one wins)."""
+    unique = []
+    seen = set()
+    for issue in issues:
+        desc = _normalize_desc(issue.get("description", ""))
+        if desc in seen:
+            continue
+        seen.add(desc)
+        unique.append(issue)
+    return unique
+
+
+def _build_rule_automaton():
+    automaton = ahocorasick.Automaton()
+    for phrase, rule in _ISSUE_TO_RULE_LOWER.items():
+        automaton.add_word(phrase, (len(phrase), rule))
+    automaton.make_automaton()
+    return automaton
+
+
+# Aho-Corasick automaton over the mapping phrases: matches every phrase in
+# a single pass over the description instead of one scan per phrase.
+_RULE_AUTOMATON = _build_rule_automaton() if ahocorasick is not None else None
+
+
+def map_issue_to_rule(description):
+    """Best-effort mapping from a panel description to an ao-lens code
+    (or tuple of codes, any of which counts as coverage).
+
+    When several phrases match, the one starting earliest wins (longest
+    phrase on ties) -- identical on both the automaton and fallback
+    paths, so classification does not depend on pyahocorasick being
+    installed.
+    """
+    lowered = _lower(description)
+    best = None
+    if _RULE_AUTOMATON is not None:
+        for end, (length, rule) in _RULE_AUTOMATON.iter(lowered):
+            key = (end - length + 1, -length)
+            if best is None or key < best[0]:
+                best = (key, rule)
+    else:
+        for phrase, rule in _ISSUE_TO_RULE_LOWER.items():
+            start = lowered.find(phrase)
+            if start < 0:
+                continue
+            key = (start, -len(phrase))
+            if best is None or key < best[0]:
+                best = (key, rule)
+    return best[1] if best else None
+
+
+def identify_gaps(panel_issues, lens_findings):
+    """Split panel issues into (gaps, covered) against ao-lens findings."""
+    gaps = []
+    covered = []
+    # One pass over the findings up front; each issue then costs a single
+    # set lookup instead of a scan of every finding.
+    covered_codes = {finding.get("code") for finding in lens_findings}
+    for issue in panel_issues:
+        rules = issue.get("missing") or map_issue_to_rule(issue.get("description", ""))
+        if isinstance(rules, str):
+            rules = (rules,)
+        if rules and any(rule in covered_codes for rule in rules):
+            covered.append(issue)
+        else:
+            gaps.append(issue)
+    return gaps, covered
+
+
+def _build_severity_trie():
+    trie = {}
+    for severity, prefixes in SEVERITY_PREFIXES.items():
+        for prefix in prefixes:
+            node = trie
+            for ch in prefix:
+                node = node.setdefault(ch, {})
+            node[""] = severity  # terminal: prefix fully matched
+    return trie
+
+
+# Character trie over SEVERITY_PREFIXES, built once at import: bucketing
+# walks each description prefix once instead of startswith per prefix.
+_SEVERITY_TRIE = _build_severity_trie()
+
+
+def _severity_for(desc):
+    node = _SEVERITY_TRIE
+    for ch in desc:
+        node = node.get(ch)
+        if node is None:
+            return "unknown"
+        severity = node.get("")
+        if severity is not None:
+            return severity
+    return "unknown"
+
+
+def bucket_by_severity(issues):
+    """Group issues by the severity prefix of their description."""
+    buckets = {"critical": [], "high": [], "medium": [], "low": [], "unknown": []}
+    for issue in issues:
+        desc = _lower(issue.get("description", ""))
+        buckets[_severity_for(desc)].append(issue)
+    return buckets
+
+
+def generate_report(gaps, covered, out_path):
+    """Write a markdown gap report to *out_path*."""
+    # Accumulate fragments and join once: += on str re-copies the whole
+    # report for every line, which is quadratic on big gap lists.
+    parts = ["# AO panel / ao-lens gap report\n\n"]
+    parts.append(f"Panel issues covered by ao-lens: {len(covered)}\n")
+    parts.append(f"Panel issues NOT covered (gaps): {len(gaps)}\n\n")
+    buckets = bucket_by_severity(gaps)
+    for severity in ("critical", "high", "medium", "low", "unknown"):
+        issues = buckets[severity]
+        if not issues:
+            continue
+        parts.append(f"## {severity} ({len(issues)})\n\n")
+        for issue in issues:
+            expert = issue.get("expert", issue.get("saga_id", "?"))
+            parts.append(f"- [{expert}] {issue.get('description', '')}")
+            if issue.get("missing"):
+                parts.append(f" (expected: {issue['missing']})")
+            parts.append("\n")
+        parts.append("\n")
+    if covered:
+        parts.append(f"## covered ({len(covered)})\n\n")
+        for issue in covered:
+            parts.append(f"- {issue.get('description', '')}\n")
+    with open(out_path, "w", encoding="utf-8") as f:
+        f.write("".join(parts))
+    return out_path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    source_group = parser.add_mutually_exclusive_group(required=True)
+    source_group.add_argument("--recent", type=int, metavar="N",
+                              help="pull panel issues from the N most recent sagas")
+    source_group.add_argument("--from-redis", metavar="SAGA_ID",
+                              help="pull panel issues for one saga")
+    source_group.add_argument("--claude-output", metavar="PATH",
+                              help="parse panel issues from a saved transcript")
+    parser.add_argument("--source", metavar="PATH",
+                        help="Lua file/directory to audit with ao-lens")
+    parser.add_argument("--lens-output", metavar="DIR",
+                        help="directory of saved ao-lens-*.json reports")
+    parser.add_argument("--skills-dir", metavar="PATH",
+                        help="passed through to ao-lens audit")
+    parser.add_argument("--report", metavar="PATH",
+                        help="write a markdown report instead of printing")
+    args = parser.parse_args(argv)
+
+    def collect_panel():
+        if args.recent is not None:
+            return get_recent_ao_panel_issues(args.recent)
+        if args.from_redis:
+            return get_ao_panel_from_redis(args.from_redis)
+        return parse_claude_output(args.claude_output)
+
+    def collect_lens():
+        if args.lens_output:
+            return parse_ao_lens_findings(args.lens_output)
+        if args.source:
+            return run_ao_lens(args.source, args.skills_dir)
+        return []
+
+    # The two sides are independent and both I/O-bound (Redis/transcript
+    # reads vs the node audit subprocess), so overlap them.
+    with ThreadPoolExecutor(max_workers=2) as pool:
+        panel_future = pool.submit(collect_panel)
+        lens_future = pool.submit(collect_lens)
+        panel_issues = deduplicate_issues(panel_future.result())
+        lens_findings = lens_future.result()
+
+    gaps, covered = identify_gaps(panel_issues, lens_findings)
+
+    if args.report:
+        path = generate_report(gaps, covered, args.report)
+        print(f"Wrote {path} ({len(gaps)} gaps, {len(covered)} covered)")
+    else:
+        for issue in gaps:
+            print(f"GAP [{issue.get('expert', '?')}] {issue.get('description', '')}")
+        print(f"{len(gaps)} gaps, {len(covered)} covered")
+    return 1 if gaps else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())